@@ -1,15 +1,36 @@
 import os
-from datetime import datetime, timedelta, date
+from datetime import datetime, date
 from typing import List, Optional, Dict
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
+from passlib.context import CryptContext
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from pydantic import BaseModel, EmailStr
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+from starlette.concurrency import run_in_threadpool
 import hashlib
+import secrets
+import time
+import orjson
 
-from database import db, create_document, get_documents
+from database import db, create_document, create_documents, get_documents, to_datetime
 from schemas import User as UserSchema, Booking as BookingSchema, Offering as OfferingSchema
 
-app = FastAPI(title="Pliva Retreat API")
+app = FastAPI(title="Pliva Retreat API", default_response_class=ORJSONResponse)
+
+# Point RATE_LIMIT_STORAGE_URI at Redis/MongoDB in production so all workers
+# share counters; memory:// is per process and only suits development.
+# Keyed on the client address uvicorn resolves from trusted proxy headers.
+limiter = Limiter(key_func=get_remote_address, storage_uri=os.getenv("RATE_LIMIT_STORAGE_URI", "memory://"))
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+
+# Day and booking lists are repetitive JSON; tiny bodies aren't worth it
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=5)
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,22 +42,44 @@ app.add_middleware(
 
 # ------- Helpers -------
 
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode("utf-8")).hexdigest()
+# Legacy unsalted SHA-256 hashes still verify and are upgraded on login
+pwd_ctx = CryptContext(schemes=["bcrypt", "hex_sha256"], deprecated=["hex_sha256"], bcrypt__rounds=12)
+
+
+async def hash_password(password: str) -> str:
+    # bcrypt is deliberately slow; keep it off the event loop
+    return await run_in_threadpool(pwd_ctx.hash, password)
+
+
+async def verify_password(password: str, password_hash: Optional[str]):
+    """Return (valid, new_hash); new_hash is set when the stored hash needs upgrading"""
+    return await run_in_threadpool(pwd_ctx.verify_and_update, password, password_hash)
+
+
+# Offerings are near-static, so keep the serialized /offerings body briefly
+OFFERINGS_CACHE_TTL = 60
+_offerings_cache = {"ts": 0.0, "body": None, "etag": None}
+
+
+def bust_offerings_cache():
+    """Call after any write to the offering collection"""
+    _offerings_cache["ts"] = 0.0
+    _offerings_cache["body"] = None
+    _offerings_cache["etag"] = None
 
 
 def daterange(start_date: date, end_date: date):
-    for n in range(int((end_date - start_date).days)):
-        yield start_date + timedelta(n)
+    # Step over ordinals (plain ints) rather than adding timedeltas
+    for k in range(start_date.toordinal(), end_date.toordinal()):
+        yield date.fromordinal(k)
 
 
-# ------- Seed offerings in DB if missing -------
+# ------- Seed offerings and indexes in DB if missing -------
 
-def ensure_offerings():
+async def ensure_offerings():
     if db is None:
         return
-    existing = list(db["offering"].find({}))
-    if existing:
+    if await db["offering"].estimated_document_count():
         return
     offerings: List[OfferingSchema] = [
         OfferingSchema(
@@ -64,11 +107,32 @@ def ensure_offerings():
             ],
         ),
     ]
-    for off in offerings:
-        create_document("offering", off.model_dump())
+    # Every worker seeds at startup; the unique index on id lets only one win
+    try:
+        await create_documents("offering", offerings)
+    except BulkWriteError as exc:
+        if any(e.get("code") != 11000 for e in exc.details.get("writeErrors", [])):
+            raise
+    bust_offerings_cache()
 
 
-ensure_offerings()
+async def ensure_indexes():
+    if db is None:
+        return
+    # Overlap queries: equality on offering first, then the date ranges
+    await db["booking"].create_index([("offering_id", 1), ("start_date", 1), ("end_date", 1)])
+    await db["booking"].create_index([("user_email", 1), ("created_at", -1)])
+    await db["user"].create_index("email", unique=True)
+    await db["offering"].create_index("id", unique=True)
+
+
+@app.on_event("startup")
+async def on_startup():
+    if db is not None:
+        # Warm the pool once here instead of on the first request
+        await db.client.admin.command("ping")
+    await ensure_indexes()
+    await ensure_offerings()
 
 # ------- Models for auth requests -------
 class RegisterRequest(BaseModel):
@@ -90,68 +154,95 @@ class AvailabilityRequest(BaseModel):
 
 # ------- Routes -------
 @app.get("/")
-def root():
+async def root():
     return {"message": "Pliva Retreat API running"}
 
 
 @app.get("/offerings")
-def list_offerings():
-    docs = get_documents("offering")
-    # Convert ObjectId to string-safe
-    for d in docs:
-        d["_id"] = str(d.get("_id"))
-    return {"items": docs}
+async def list_offerings(request: Request):
+    if _offerings_cache["body"] is None or time.monotonic() - _offerings_cache["ts"] >= OFFERINGS_CACHE_TTL:
+        docs = await get_documents("offering")
+        # Convert ObjectId to string-safe
+        for d in docs:
+            d["_id"] = str(d.get("_id"))
+        body = orjson.dumps({"items": docs})
+        _offerings_cache["ts"] = time.monotonic()
+        _offerings_cache["body"] = body
+        # Weak tag: the body may be sent gzip-encoded or as-is
+        _offerings_cache["etag"] = 'W/"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+
+    etag = _offerings_cache["etag"]
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={OFFERINGS_CACHE_TTL}"}
+    if_none_match = request.headers.get("if-none-match")
+    # If-None-Match uses weak comparison, so ignore any W/ prefix on either side
+    tags = [t.strip().removeprefix("W/") for t in (if_none_match or "").split(",")]
+    if "*" in tags or etag.removeprefix("W/") in tags:
+        return Response(status_code=304, headers=headers)
+    return Response(_offerings_cache["body"], media_type="application/json", headers=headers)
 
 
 @app.post("/register")
-def register(payload: RegisterRequest):
-    existing = db["user"].find_one({"email": payload.email}) if db else None
-    if existing:
-        raise HTTPException(status_code=400, detail="Email already registered")
+async def register(payload: RegisterRequest):
     user = UserSchema(
         name=payload.name,
         email=payload.email,
-        password_hash=hash_password(payload.password),
+        password_hash=await hash_password(payload.password),
         avatar_url=None,
     )
-    uid = create_document("user", user)
+    # The unique index on email rejects duplicates atomically
+    try:
+        uid = await create_document("user", user)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     return {"ok": True, "user_id": uid}
 
 
 @app.post("/login")
-def login(payload: LoginRequest):
-    u = db["user"].find_one({"email": payload.email}) if db else None
-    if not u or u.get("password_hash") != hash_password(payload.password):
+@limiter.limit("10/minute")
+async def login(request: Request, payload: LoginRequest):
+    u = await db["user"].find_one({"email": payload.email}) if db is not None else None
+    valid, new_hash = await verify_password(payload.password, u.get("password_hash") if u else None)
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    token = hash_password(payload.email + "|" + str(datetime.utcnow()))
+    if new_hash:
+        await db["user"].update_one({"_id": u["_id"]}, {"$set": {"password_hash": new_hash}})
+    token = secrets.token_urlsafe(32)
     return {"ok": True, "token": token, "name": u.get("name"), "email": u.get("email")}
 
 
 @app.post("/availability")
-def check_availability(req: AvailabilityRequest):
-    # Gather bookings overlapping the range for this offering
-    query = {
-        "offering_id": req.offering_id,
-        "$or": [
-            {"start_date": {"$lt": req.end_date.isoformat()}, "end_date": {"$gt": req.start_date.isoformat()}},
-        ],
-    }
-    bookings = list(db["booking"].find(query)) if db else []
+async def check_availability(req: AvailabilityRequest):
+    # Clip overlapping bookings to the window as day offsets from its start
+    window_start = to_datetime(req.start_date)
+    window_end = to_datetime(req.end_date)
+    pipeline = [
+        {"$match": {
+            "offering_id": req.offering_id,
+            "start_date": {"$lt": window_end},
+            "end_date": {"$gt": window_start},
+        }},
+        {"$project": {
+            "_id": 0,
+            "s": {"$dateDiff": {"startDate": window_start, "endDate": {"$max": ["$start_date", window_start]}, "unit": "day"}},
+            "e": {"$dateDiff": {"startDate": window_start, "endDate": {"$min": ["$end_date", window_end]}, "unit": "day"}},
+        }},
+    ]
+    ranges = await db["booking"].aggregate(pipeline).to_list(length=None) if db is not None else []
 
-    unavailable = set()
-    for b in bookings:
-        b_start = date.fromisoformat(b["start_date"]) if isinstance(b["start_date"], str) else b["start_date"].date()
-        b_end = date.fromisoformat(b["end_date"]) if isinstance(b["end_date"], str) else b["end_date"].date()
-        for d in daterange(b_start, b_end):
-            unavailable.add(d.isoformat())
+    # Bit i set means day i of the window is booked
+    mask = 0
+    for r in ranges:
+        if r["e"] > r["s"]:
+            mask |= ((1 << (r["e"] - r["s"])) - 1) << r["s"]
 
     days = []
-    for d in daterange(req.start_date, req.end_date):
+    for i, d in enumerate(daterange(req.start_date, req.end_date)):
         days.append({
             "date": d.isoformat(),
-            "available": d.isoformat() not in unavailable
+            "available": not (mask >> i) & 1
         })
-    return {"days": days}
+    # Plain str/bool payload: skip jsonable_encoder and hand straight to orjson
+    return ORJSONResponse({"days": days})
 
 
 class CreateBookingRequest(BaseModel):
@@ -163,20 +254,19 @@ class CreateBookingRequest(BaseModel):
 
 
 @app.post("/book")
-def create_booking(req: CreateBookingRequest):
+async def create_booking(req: CreateBookingRequest):
     # Validate offering exists
-    off = db["offering"].find_one({"id": req.offering_id}) if db else None
+    off = await db["offering"].find_one({"id": req.offering_id}) if db is not None else None
     if not off:
         raise HTTPException(status_code=404, detail="Offering not found")
 
     # Conflict check
-    conflict = db["booking"].find_one({
+    conflict = await db["booking"].count_documents({
         "offering_id": req.offering_id,
-        "$or": [
-            {"start_date": {"$lt": req.end_date.isoformat()}, "end_date": {"$gt": req.start_date.isoformat()}},
-        ],
+        "start_date": {"$lt": to_datetime(req.end_date)},
+        "end_date": {"$gt": to_datetime(req.start_date)},
         "status": {"$ne": "cancelled"}
-    }) if db else None
+    }, limit=1) if db is not None else 0
 
     if conflict:
         raise HTTPException(status_code=400, detail="Selected dates are no longer available")
@@ -197,20 +287,22 @@ def create_booking(req: CreateBookingRequest):
         status="confirmed",
         note=None,
     )
-    bid = create_document("booking", booking)
+    bid = await create_document("booking", booking)
     return {"ok": True, "booking_id": bid, "total_price": total}
 
 
 @app.get("/bookings")
-def my_bookings(email: EmailStr):
-    items = list(db["booking"].find({"user_email": email}).sort("created_at", -1)) if db else []
+async def my_bookings(email: EmailStr):
+    items = await db["booking"].find({"user_email": email}, {"note": 0}).sort("created_at", -1).to_list(length=None) if db is not None else []
     for it in items:
         it["_id"] = str(it.get("_id"))
-    return {"items": items}
+        it["start_date"] = it["start_date"].date().isoformat()
+        it["end_date"] = it["end_date"].date().isoformat()
+    return ORJSONResponse({"items": items})
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -226,7 +318,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -242,4 +334,18 @@ def test_database():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+    # Trust X-Forwarded-For from the reverse proxy so request.client is the real client
+    forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1,172.20.0.1")
+    # Multiple workers need the app as an import string, not the object
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
+        proxy_headers=True,
+        forwarded_allow_ips=forwarded_allow_ips,
+    )
@@ -5,16 +5,20 @@ Each Pydantic model represents a MongoDB collection.
 Collection name is the lowercase of the class name.
 """
 from typing import Optional, List
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, ConfigDict, Field, EmailStr
 from datetime import date
 
 class User(BaseModel):
+    model_config = ConfigDict(defer_build=False)
+
     name: str = Field(..., description="Full name")
     email: EmailStr = Field(..., description="Email address")
     password_hash: str = Field(..., description="Hashed password")
     avatar_url: Optional[str] = Field(None, description="Profile image URL")
 
 class Offering(BaseModel):
+    model_config = ConfigDict(defer_build=False)
+
     id: str = Field(..., description="Unique ID e.g. 'van' or 'cabin'")
     title: str
     description: str
@@ -24,6 +28,8 @@ class Offering(BaseModel):
     photos: List[str] = []
 
 class Booking(BaseModel):
+    model_config = ConfigDict(defer_build=False)
+
     user_email: EmailStr
     offering_id: str = Field(..., description="'van' or 'cabin'")
     start_date: date